@@ -4,7 +4,10 @@
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
+import os
 import time
+import socket
+import binascii
 
 from ansible.plugins.action import ActionBase
 from ansible.errors import AnsibleActionFail, AnsibleConnectionFailure
@@ -17,9 +20,19 @@ display = Display()
 class ActionModule(ActionBase):
 
     # Keep internal params away from user interactions
-    _VALID_ARGS = frozenset(('path', 'state', 'table', 'noflush', 'counters', 'modprobe', 'ip_version', 'wait'))
+    _VALID_ARGS = frozenset((
+        'path', 'state', 'table', 'noflush', 'analyze', 'prune', 'counters',
+        'modprobe', 'ip_version', 'wait', 'samples', 'interval', 'markers',
+        'confirm', 'confirm_port', 'snapshot', 'snapshot_dir', 'snapshot_keep'))
     DEFAULT_SUDOABLE = True
 
+    # How to confirm the restored state from the controller
+    CONFIRM_METHODS = dict(
+        reconnect='_confirm_reconnect',
+        tcp='_confirm_token',
+        udp='_confirm_token',
+    )
+
     MSG_ERROR__ASYNC_AND_POLL_NOT_ZERO = (
         "This module doesn't support async>0 and poll>0 when its 'state' param "
         "is set to 'restored'. To enable its rollback feature (that needs the "
@@ -58,6 +71,71 @@ class ActionModule(ActionBase):
 
         return async_result
 
+    def _confirm_reconnect(self, confirm_cmd, module_args, timeout):
+        '''
+        Reset the connection and retry to remove the backup on the remote
+        through a new one, once per second. Return the number of attempts.
+        '''
+        try:
+            self._connection.reset()
+        except AttributeError:
+            pass
+
+        attempts = 0
+        for attempts in range(1, timeout + 1):
+            time.sleep(1)
+            # - AnsibleConnectionFailure covers rejected requests (i.e.
+            #   by rules with '--jump REJECT')
+            # - ansible_timeout is able to cover dropped requests (due
+            #   to a rule or policy DROP) if not lower than async_val.
+            try:
+                dummy = self._low_level_execute_command(confirm_cmd, sudoable=self.DEFAULT_SUDOABLE)
+                break
+            except AnsibleConnectionFailure:
+                continue
+        return attempts
+
+    def _send_token(self, proto, host, port, token):
+        '''
+        Send the token to the module, and return True if it acknowledged it.
+        '''
+        kind = socket.SOCK_STREAM if proto == 'tcp' else socket.SOCK_DGRAM
+        try:
+            family, dummy, dummy, dummy, address = socket.getaddrinfo(host, port, 0, kind)[0]
+            sock = socket.socket(family, kind)
+        except socket.error:
+            return False
+        try:
+            sock.settimeout(1)
+            if proto == 'tcp':
+                sock.connect(address)
+                sock.sendall(token.encode() + b'\n')
+                return sock.recv(16).strip() == b'ok'
+            sock.sendto(token.encode() + b'\n', address)
+            return sock.recvfrom(16)[0].strip() == b'ok'
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def _confirm_token(self, confirm_cmd, module_args, timeout):
+        '''
+        Send the token the module waits for on a TCP or UDP port, once per
+        second, as it is refused until the state is restored. Fall back to
+        reconnect after half of the timeout (3 attempts at least).
+        '''
+        host = self._play_context.remote_addr
+        attempts = 0
+        for attempts in range(1, min(max(3, timeout // 2), timeout) + 1):
+            started = time.time()
+            if self._send_token(module_args['confirm'], host, module_args['confirm_port'], module_args['_token']):
+                return attempts
+            # An attempt lasts one second, whether the token is dropped or
+            # rejected.
+            time.sleep(max(0, started + 1 - time.time()))
+        display.vvv("No acknowledgement of the token from %s, falling back to reconnect" % host)
+        return attempts + self._confirm_reconnect(confirm_cmd, module_args, timeout - attempts)
+
     def run(self, tmp=None, task_vars=None):
 
         self._supports_check_mode = True
@@ -106,6 +184,7 @@ class ActionModule(ActionBase):
                     # longer on the controller); and set a backup file path.
                     module_args['_timeout'] = task_async
                     module_args['_back'] = '%s/iptables.state' % async_dir
+                    module_args['_token'] = binascii.hexlify(os.urandom(16)).decode()
                     async_status_args = dict(_async_dir=async_dir)
                     confirm_cmd = 'rm -f %s' % module_args['_back']
                     starter_cmd = 'touch %s.starter' % module_args['_back']
@@ -117,7 +196,8 @@ class ActionModule(ActionBase):
             # Then the 3-steps "go ahead or rollback":
             # 1. Catch early errors of the module (in asynchronous task) if any.
             #    Touch a file on the target to signal the module to process now.
-            # 2. Reset connection to ensure a persistent one will not be reused.
+            # 2. Reset connection (or send a token to the module) to ensure a
+            #    persistent one will not be reused.
             # 3. Confirm the restored state by removing the backup on the remote.
             #    Retrieve the results of the asynchronous task to return them.
             if '_back' in module_args:
@@ -137,23 +217,8 @@ class ActionModule(ActionBase):
                 # As the main command is not yet executed on the target, here
                 # 'finished' means 'failed before main command be executed'.
                 if not result['finished']:
-                    try:
-                        self._connection.reset()
-                    except AttributeError:
-                        pass
-
-                    for dummy in range(max_timeout):
-                        time.sleep(1)
-                        remaining_time -= 1
-                        # - AnsibleConnectionFailure covers rejected requests (i.e.
-                        #   by rules with '--jump REJECT')
-                        # - ansible_timeout is able to cover dropped requests (due
-                        #   to a rule or policy DROP) if not lower than async_val.
-                        try:
-                            dummy = self._low_level_execute_command(confirm_cmd, sudoable=self.DEFAULT_SUDOABLE)
-                            break
-                        except AnsibleConnectionFailure:
-                            continue
+                    confirm = getattr(self, self.CONFIRM_METHODS.get(module_args.get('confirm'), '_confirm_reconnect'))
+                    remaining_time -= confirm(confirm_cmd, module_args, max_timeout)
 
                     result = merge_hash(result, self._async_result(async_status_args, task_vars, remaining_time))
 
@@ -163,7 +228,7 @@ class ActionModule(ActionBase):
                         del result[key]
 
                 if result.get('invocation', {}).get('module_args'):
-                    for key in ('_back', '_timeout', '_async_dir', 'jid'):
+                    for key in ('_back', '_timeout', '_token', '_async_dir', 'jid'):
                         if result['invocation']['module_args'].get(key):
                             del result['invocation']['module_args'][key]
 
@@ -0,0 +1,122 @@
+# Copyright: (c) 2021, quidame <quidame@poivron.org>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import re
+
+from ansible.errors import AnsibleFilterError
+from ansible.module_utils._text import to_text
+
+
+# Rendered lines and regexps, per rule. Playbooks apply the same rules to a
+# lot of hosts, so they are computed once per controller process.
+CACHE = dict()
+
+WORD_RE = re.compile(r'\w+')
+
+
+def rule_params(rule):
+    '''
+    Return the values of the rule's keys, with the same defaults than the
+    role's tasks and template.
+    '''
+    try:
+        name = to_text(rule['name'])
+        dport = to_text(rule['dport'])
+    except KeyError as err:
+        raise AnsibleFilterError("Missing mandatory key %s in rule %s" % (err, rule))
+    except TypeError:
+        raise AnsibleFilterError("Rule must be a dictionary, got %s" % type(rule))
+
+    saddr = rule.get('saddr')
+    if saddr is not None and '/' not in to_text(saddr):
+        saddr = '%s/32' % saddr
+
+    return dict(
+        chain=to_text(rule.get('chain', 'INPUT')),
+        protocol=to_text(rule.get('protocol', 'tcp')),
+        jump=to_text(rule.get('jump', 'ACCEPT')),
+        saddr=saddr,
+        dport=dport,
+        name=name)
+
+
+def cached(kind, rule, saddr, build):
+    '''
+    Return the string built from the rule, computing it only if this rule has
+    not already been seen.
+    '''
+    try:
+        key = (kind, saddr, tuple(sorted(rule.items())))
+        hash(key)
+    except (AttributeError, TypeError):
+        return build(rule_params(rule), saddr)
+
+    if key not in CACHE:
+        CACHE[key] = build(rule_params(rule), saddr)
+    return CACHE[key]
+
+
+def build_rule(params, saddr):
+    # The build `name|replace('-','_')|wordcount` mimics iptables command
+    # behaviour regarding double quotes enclosures: jinja's wordcount alone
+    # fails idempotency for names such as `foo-bar`, since `-` is a word
+    # separator for jinja2, not for iptables.
+    name = params['name']
+    if len(WORD_RE.findall(name.replace('-', '_'))) != 1:
+        name = re.sub('^|$', '"', name)
+
+    if ',' in params['dport']:
+        match = 'multiport --dports %s' % params['dport']
+    else:
+        match = '%s --dport %s' % (params['protocol'], params['dport'])
+
+    source = ''
+    if saddr and params['saddr'] is not None:
+        source = ' -s %s' % params['saddr']
+
+    return '-A %s%s -p %s -m %s -m comment --comment %s -j %s' % (
+        params['chain'], source, params['protocol'], match, name, params['jump'])
+
+
+def build_regexp(params, saddr):
+    # Catch rules matching either the `dport` or the `name` values, making
+    # easy to never 'duplicate' a rule nor keep obsolete rules as long as we
+    # don't modify `name` and `dport` at the same time.
+    source = '.*'
+    if params['saddr'] is not None:
+        source = params['saddr']
+
+    return (
+        '^(-A %(chain)s( -s %(source)s)? -p %(protocol)s -m (multiport|%(protocol)s) '
+        '--dports? ((%(dport)s -m comment --comment .*)|'
+        '(.* -m comment --comment ("?)%(name)s\\7)) -j %(jump)s)$' % dict(params, source=source))
+
+
+def iptables_apply_rule(rule, saddr=True):
+    '''
+    Render a rule of the role (a dict with `name`, `dport` and optional
+    `chain`, `protocol`, `saddr` and `jump` keys) as a line of iptables-save
+    output. If `saddr` is false, the source address is not rendered.
+    '''
+    return cached('rule', rule, bool(saddr), build_rule)
+
+
+def iptables_apply_regexp(rule):
+    '''
+    Return the regexp matching the line of a rule of the role, or the line of
+    the same rule with another destination port or another comment.
+    '''
+    return cached('regexp', rule, None, build_regexp)
+
+
+class FilterModule(object):
+    ''' iptables_apply filters '''
+
+    def filters(self):
+        return {
+            'iptables_apply_rule': iptables_apply_rule,
+            'iptables_apply_regexp': iptables_apply_regexp,
+        }
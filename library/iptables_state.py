@@ -35,20 +35,75 @@ notes:
     still happen if it shall happen, but you will experience a connection
     timeout instead of more relevant info returned by the module after its
     failure.
-  - This module supports I(check_mode).
+  - This module supports I(check_mode) and I(diff_mode).
+  - With I(state=sampled), the module runs for I(samples) times I(interval)
+    seconds at least. Set task attribute I(async) accordingly to not reach
+    C(ANSIBLE_TIMEOUT).
 options:
+  analyze:
+    description:
+      - Parse the ruleset per table and chain, and report rules that can never
+        match any packet because earlier rules of the same chain already
+        match all of them (C(shadowed) if at least one of these earlier rules
+        has another target, C(redundant) otherwise), rules of user-defined
+        chains that are never jumped to (C(unreachable)) and user-defined
+        chains without rules (C(empty_chains)).
+      - When I(state=saved), the saved ruleset is analyzed. When
+        I(state=restored), the ruleset to restore is analyzed before being
+        applied.
+      - Only C(-A) and C(-I) commands are supported; a table using other
+        commands is not analyzed, with a warning.
+    type: bool
+    default: false
+  confirm:
+    description:
+      - For I(state=restored) played asynchronously, ignored otherwise.
+      - How the controller confirms that it can still reach the host once the
+        new state is restored, to not roll it back.
+      - With C(reconnect), the controller opens a new connection to remove
+        the backup file on the host.
+      - With C(tcp) or C(udp), the module listens on I(confirm_port) and the
+        controller sends it a token directly, without the cost of a new
+        connection and privilege escalation. Note that it only proves that
+        the new ruleset lets the controller reach this port. The module
+        listens once the new state is restored, so the token goes through
+        it as a new flow; the controller sends it again until then. If the
+        token can't be delivered within half of the timeout (3 seconds at
+        least), C(reconnect) is used.
+    type: str
+    choices: [ reconnect, tcp, udp ]
+    default: reconnect
+  confirm_port:
+    description:
+      - The port the module listens on when I(confirm=tcp) or I(confirm=udp).
+      - The new ruleset must accept packets from the controller to this port.
+    type: int
   counters:
     description:
       - Save or restore the values of all packet and byte counters.
       - When C(true), the module is not idempotent.
     type: bool
     default: false
+  interval:
+    description:
+      - For I(state=sampled), ignored otherwise.
+      - The number of seconds to wait between two snapshots of the counters.
+    type: float
+    default: 1
   ip_version:
     description:
       - Which version of the IP protocol this module should apply to.
     type: str
     choices: [ ipv4, ipv6 ]
     default: ipv4
+  markers:
+    description:
+      - For I(state=probed), ignored otherwise.
+      - The lines to look for in the current state of the firewall, as they
+        are written by C(iptables-save) (but with zeroed counters).
+    type: list
+    elements: str
+    default: []
   modprobe:
     description:
       - Specify the path to the C(modprobe) program internally used by iptables
@@ -69,14 +124,69 @@ options:
     description:
       - The file the iptables state should be saved to.
       - The file the iptables state should be restored from.
+      - The file the rates should be written to.
+      - Required unless I(state=probed), or I(state=restored) with
+        I(snapshot) set.
     type: path
-    required: yes
+  prune:
+    description:
+      - For I(state=restored), ignored otherwise.
+      - If C(true), the rules reported by I(analyze) as C(shadowed),
+        C(redundant) or C(unreachable) are removed from I(path) before it is
+        restored, as well as the declarations of the user-defined chains that
+        are never jumped to. Implies I(analyze=true).
+      - Empty chains that are jumped to are reported but left untouched.
+      - With I(noflush=true), user-defined chains are assumed to be reachable
+        from the current rules, and are never removed.
+      - Rewriting I(path) is reported as a change, even if the restored state
+        is the same as the initial one.
+    type: bool
+    default: false
+  samples:
+    description:
+      - For I(state=sampled), ignored otherwise.
+      - The number of snapshots of the counters to take.
+    type: int
+    default: 5
+  snapshot:
+    description:
+      - For I(state=restored), ignored otherwise.
+      - Restore the state from this snapshot of I(snapshot_dir) instead of
+        I(path), with the same rollback feature.
+      - Mutually exclusive with I(path).
+      - Either the id of the snapshot (or a unique prefix of at least 7
+        characters of it), or its position from the last one, i.e. C(-1) for
+        the last one, C(-2) for the previous one, and so on.
+    type: str
+  snapshot_dir:
+    description:
+      - The directory of the snapshots store.
+      - When I(state=saved), the saved state is also added to the store, as
+        the last snapshot. Tables are stored compressed and only once, even
+        if they belong to several snapshots.
+      - Required with I(snapshot).
+      - The store is locked while the module reads or updates it, so several
+        runs of the module can share it.
+    type: path
+  snapshot_keep:
+    description:
+      - The number of snapshots to keep in the store. When a new snapshot is
+        added, the oldest ones are evicted, and the tables they are the only
+        ones to use are removed.
+    type: int
+    default: 10
   state:
     description:
       - Whether the firewall state should be saved (into a file) or restored
         (from a file).
+      - With C(sampled), the packet and byte counters are read I(samples)
+        times, every I(interval) seconds, to compute the rates of the rules
+        and policies; these rates are written into the file. The ruleset
+        itself is not modified.
+      - With C(probed), only the presence of I(markers) in the current state
+        and per table digests of this state are returned. Nothing is written.
     type: str
-    choices: [ saved, restored ]
+    choices: [ saved, restored, sampled, probed ]
     required: yes
   table:
     description:
@@ -85,6 +195,8 @@ options:
         the file.
       - When I(state=saved), restrict output to the specified table. If not
         specified, output includes all active tables.
+      - When I(state=sampled) or I(state=probed), restrict the state read to
+        the specified table.
     type: str
     choices: [ filter, nat, mangle, raw, security ]
   wait:
@@ -127,6 +239,51 @@ EXAMPLES = r'''
   async: "{{ ansible_timeout }}"
   poll: 0
 
+# This will remove dead rules from the file before loading it
+- name: restore firewall state from a file, without shadowed rules
+  community.general.iptables_state:
+    state: restored
+    path: /run/iptables.apply
+    prune: true
+  async: "{{ ansible_timeout }}"
+  poll: 0
+
+# This will measure the traffic hitting each rule for one minute
+- name: sample firewall counters
+  community.general.iptables_state:
+    state: sampled
+    path: /tmp/iptables.rates
+    samples: 7
+    interval: 10
+  async: 90
+  poll: 5
+  register: iptables_rates
+
+# This will keep the current state in a store of snapshots too
+- name: save current state of the firewall in system file, and in the store
+  community.general.iptables_state:
+    state: saved
+    path: /etc/sysconfig/iptables
+    snapshot_dir: /var/lib/iptables_state
+
+# This will load the state that was current before the last save
+- name: roll back to the previous snapshot
+  community.general.iptables_state:
+    state: restored
+    snapshot_dir: /var/lib/iptables_state
+    snapshot: '-2'
+  async: "{{ ansible_timeout }}"
+  poll: 0
+
+# This will only tell if a rule is currently applied
+- name: look for a rule in the current state of the firewall
+  community.general.iptables_state:
+    state: probed
+    table: filter
+    markers:
+      - '-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT'
+  register: iptables_probe
+
 # This will only retrieve information
 - name: get current state of the firewall
   community.general.iptables_state:
@@ -142,16 +299,100 @@ EXAMPLES = r'''
 '''
 
 RETURN = r'''
+analysis:
+  description:
+    - The findings of the ruleset analysis, per table.
+    - Rules are identified by their chain and their number in this chain, in
+      the order they are evaluated.
+  type: dict
+  returned: when I(analyze=true) or I(prune=true)
+  sample: |-
+    {
+      "filter": {
+        "empty_chains": [],
+        "redundant": [
+          {
+            "by": [2],
+            "chain": "INPUT",
+            "num": 3,
+            "rule": "-A INPUT -p tcp -m tcp --dport 22 -m comment --comment \"ssh again\" -j ACCEPT"
+          }
+        ],
+        "shadowed": [
+          {
+            "by": [4],
+            "chain": "INPUT",
+            "num": 5,
+            "rule": "-A INPUT -s 10.1.2.3/32 -p tcp -m tcp --dport 443 -j DROP"
+          }
+        ],
+        "unreachable": []
+      }
+    }
 applied:
   description: Whether or not the wanted state has been successfully restored.
   type: bool
   returned: always
   sample: true
+confirmation:
+  description:
+    - How the restored state has been confirmed, C(token) if the module
+      received the token sent by the controller (I(confirm=tcp) or
+      I(confirm=udp)), C(reconnect) if the controller removed the backup
+      file through a new connection.
+  type: str
+  returned: when I(state=restored) is played asynchronously and applied
+  sample: token
+diff:
+  description:
+    - For I(state=restored), the changes between the initial state and the
+      restored one (or the one to restore, in check mode), per table.
+    - I(tables) is a dict of tables, each one with the policies that change
+      (old and new values), the user-defined chains that are C(created) or
+      C(deleted), and per chain the rules that are C(added), C(removed) or
+      C(moved) (with their new position I(num), and for moved rules their
+      previous one I(was)). Lines that are not understood are listed under
+      C(unparsed), and are taken as changes in check mode.
+    - I(prepared) is the same diff as text, for the C(--diff) output.
+  type: dict
+  returned: when run with C(--diff)
+  sample: {
+      "tables": {
+        "filter": {
+          "policies": {"INPUT": ["ACCEPT", "DROP"]},
+          "chains": {
+            "INPUT": {
+              "added": [{"num": 3, "rule": "-A INPUT -p tcp -m tcp --dport 443 -j ACCEPT"}],
+              "moved": [{"num": 1, "was": 2, "rule": "-A INPUT -i lo -j ACCEPT"}]
+            }
+          }
+        }
+      },
+      "prepared": "..."
+    }
+digests:
+  description:
+    - The SHA-1 digests of the tables of the current state, from their
+      declaration to their C(COMMIT), without comments. They change when the
+      policies or the rules of the table change, and name the tables in the
+      snapshot store.
+  type: dict
+  returned: when I(state=probed)
+  sample: {
+      "filter": "0a4d55a8d778e5022fab701977c5d840bbc486d0"
+    }
+elapsed:
+  description:
+    - The number of seconds between the first and the last snapshots of the
+      counters, the I(rates) are computed over.
+  type: float
+  returned: when I(state=sampled)
+  sample: 4.012
 initial_state:
   description: The current state of the firewall when module starts.
   type: list
   elements: str
-  returned: always
+  returned: when I(state) is C(saved) or C(restored)
   sample: [
       "# Generated by xtables-save v1.8.2",
       "*filter",
@@ -161,6 +402,44 @@ initial_state:
       "COMMIT",
       "# Completed"
     ]
+markers:
+  description: Whether each of the I(markers) is found or not in the current state.
+  type: dict
+  returned: when I(state=probed)
+  sample: {
+      "-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT": true
+    }
+pruned:
+  description: The lines removed from I(path) before restoring it.
+  type: list
+  elements: str
+  returned: when I(prune=true) and I(state=restored)
+  sample: [
+      "-A INPUT -p tcp -m tcp --dport 22 -m comment --comment \"ssh again\" -j ACCEPT"
+    ]
+rates:
+  description:
+    - The packet and byte rates of each rule and each policy, per second,
+      and the total of packets and bytes matched during the sampling.
+    - I(num) is the position of the rule in its chain, or C(0) for the policy
+      of the chain.
+    - The same data is written into I(path), one line per rule, fields being
+      separated by spaces in this order (the rule coming last).
+  type: list
+  elements: dict
+  returned: when I(state=sampled)
+  sample: [
+      {
+        "table": "filter",
+        "chain": "INPUT",
+        "num": 1,
+        "pps": 12.5,
+        "bps": 10375.2,
+        "packets": 50,
+        "bytes": 41501,
+        "rule": "-A INPUT -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT"
+      }
+    ]
 restored:
   description: The state the module restored, whenever it is finally applied or not.
   type: list
@@ -180,6 +459,11 @@ restored:
       "COMMIT",
       "# Completed"
     ]
+snapshot:
+  description: The id of the snapshot saved into or restored from I(snapshot_dir).
+  type: str
+  returned: when I(snapshot_dir) is set and I(state) is C(saved), or I(snapshot) is set
+  sample: "6c1b0e9e3cc7bd5a76fa3dad44ed3ec2e4a3b4a1"
 saved:
   description: The iptables state the module saved.
   type: list
@@ -220,13 +504,24 @@ tables:
         ":POSTROUTING ACCEPT"
       ]
     }
-  returned: always
+  returned: when I(state) is C(saved) or C(restored)
 '''
 
 
 import re
 import os
 import time
+import errno
+import fcntl
+import array
+import gzip
+import json
+import hashlib
+import select
+import socket
+import bisect
+import itertools
+import binascii
 import tempfile
 import filecmp
 import shutil
@@ -252,6 +547,126 @@ RESTORE = dict(
 
 TABLES = ['filter', 'mangle', 'nat', 'raw', 'security']
 
+BUILTIN_CHAINS = dict(
+    filter=['INPUT', 'FORWARD', 'OUTPUT'],
+    mangle=['PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'POSTROUTING'],
+    nat=['PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING'],
+    raw=['PREROUTING', 'OUTPUT'],
+    security=['INPUT', 'FORWARD', 'OUTPUT'],
+)
+
+# Targets that end the traversal of the chain for the packets they match.
+TERMINAL_TARGETS = frozenset([
+    'ACCEPT', 'DROP', 'REJECT', 'RETURN',
+    'DNAT', 'SNAT', 'MASQUERADE', 'REDIRECT', 'NETMAP',
+])
+
+# Matches that don't always match the same packets, so rules using them
+# can't hide the next ones.
+VOLATILE_MATCHES = frozenset(['limit', 'hashlimit', 'statistic', 'quota', 'nth', 'random'])
+
+BASIC_OPTIONS = {
+    '-p': 'protocol', '--protocol': 'protocol',
+    '-s': 'src', '--source': 'src', '--src': 'src',
+    '-d': 'dst', '--destination': 'dst', '--dst': 'dst',
+    '-i': 'iif', '--in-interface': 'iif',
+    '-o': 'oif', '--out-interface': 'oif',
+    '-j': 'jump', '--jump': 'jump',
+    '-g': 'goto', '--goto': 'goto',
+    '-m': 'match', '--match': 'match',
+    '-c': 'counters', '--set-counters': 'counters',
+}
+
+PORT_OPTIONS = {
+    '--sport': 'sport', '--source-port': 'sport',
+    '--sports': 'sport', '--source-ports': 'sport',
+    '--dport': 'dport', '--destination-port': 'dport',
+    '--dports': 'dport', '--destination-ports': 'dport',
+}
+
+FULL_RANGE = [(0, 65535)]
+
+POLICY_COUNTERS_RE = re.compile(r'^:(\S+) (\S+) \[([0-9]+):([0-9]+)\]')
+
+RULE_COUNTERS_RE = re.compile(r'^\[([0-9]+):([0-9]+)\] (-A (\S+) .*?)\s*$')
+
+COUNTERS_PREFIX_RE = re.compile(r'^\[[0-9]+:[0-9]+\]\s*')
+
+TOKEN_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+
+class Ruleset(object):
+    '''
+    Store each distinct line of the iptables states handled by the module only
+    once, whatever the number of states (initial, restored, per table...) it
+    belongs to.
+    '''
+
+    def __init__(self):
+        self.store = []
+        self.index = dict()
+
+    def view(self, lines):
+        '''
+        Intern the lines, and return a view of them as a state.
+        '''
+        ids = array.array('L')
+        for line in lines:
+            i = self.index.get(line)
+            if i is None:
+                i = self.index[line] = len(self.store)
+                self.store.append(line)
+            ids.append(i)
+        return RulesetView(self, ids)
+
+
+class RulesetView(object):
+    '''
+    An iptables state, as indexes of lines in a Ruleset. Views compare by
+    their per table digests, computed once.
+    '''
+
+    __slots__ = ('ruleset', 'ids', '_digests')
+
+    def __init__(self, ruleset, ids):
+        self.ruleset = ruleset
+        self.ids = ids
+        self._digests = None
+
+    def __iter__(self):
+        store = self.ruleset.store
+        return (store[i] for i in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, line):
+        i = self.ruleset.index.get(line)
+        return i is not None and i in self.ids
+
+    def __eq__(self, other):
+        if not isinstance(other, RulesetView):
+            return NotImplemented
+        return self.digests() == other.digests()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def lines(self):
+        return list(self)
+
+    def digests(self):
+        '''
+        Return the list of (table, digest) of the state, in order. All lines of
+        a per table state are digested under an empty table name.
+        '''
+        if self._digests is None:
+            self._digests = [(t, d) for (t, d, dummy) in table_blobs(self)]
+        return self._digests
+
 
 def read_state(b_path):
     '''
@@ -262,7 +677,7 @@ def read_state(b_path):
     lines = text.splitlines()
     while '' in lines:
         lines.remove('')
-    return lines
+    return ruleset.view(lines)
 
 
 def write_state(b_path, lines, changed):
@@ -285,7 +700,7 @@ def write_state(b_path, lines, changed):
             except Exception as err:
                 module.fail_json(
                     msg='Error creating %s: %s' % (destdir, to_native(err)),
-                    initial_state=lines)
+                    initial_state=list(lines))
         changed = True
 
     elif not filecmp.cmp(tmpfile, b_path):
@@ -299,7 +714,7 @@ def write_state(b_path, lines, changed):
             path = to_native(b_path, errors='surrogate_or_strict')
             module.fail_json(
                 msg='Error saving state into %s: %s' % (path, to_native(err)),
-                initial_state=lines)
+                initial_state=list(lines))
 
     return changed
 
@@ -331,7 +746,7 @@ def filter_and_format_state(string):
     lines = string.splitlines()
     while '' in lines:
         lines.remove('')
-    return lines
+    return ruleset.view(lines)
 
 
 def per_table_state(command, state):
@@ -350,33 +765,934 @@ def per_table_state(command, state):
             table = out.splitlines()
             while '' in table:
                 table.remove('')
-            tables[t] = table
+            tables[t] = ruleset.view(table)
     return tables
 
 
+def tables_lines(tables):
+    '''
+    Convert per table views back into lists, to return them.
+    '''
+    return dict((t, tables[t].lines()) for t in tables)
+
+
+def tokenize_rule(line):
+    '''
+    Split a rule line into tokens, honoring double quoted strings (such as
+    comments) the way iptables-save writes them. Quoted strings are kept with
+    their quotes, so they are never taken for options.
+    '''
+    if '"' not in line:
+        return line.split()
+    return [m.group(0) for m in TOKEN_RE.finditer(line)]
+
+
+def parse_address(value):
+    '''
+    Convert an address with an optional CIDR or dotted mask into a tuple of
+    (bits, prefix length, network as an integer). Return None for anything
+    that is not a numeric address (i.e. a hostname or a list of addresses).
+    '''
+    addr, dummy, mask = value.partition('/')
+    for family, bits in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            number = int(binascii.hexlify(socket.inet_pton(family, addr)), 16)
+        except (socket.error, ValueError):
+            continue
+        if not mask:
+            plen = bits
+        elif mask.isdigit():
+            plen = int(mask)
+        else:
+            try:
+                b_mask = bin(int(binascii.hexlify(socket.inet_pton(family, mask)), 16))
+            except (socket.error, ValueError):
+                return None
+            plen = b_mask.count('1')
+            if b_mask.rstrip('0').count('0') > 1:
+                return None
+        if plen > bits:
+            return None
+        return (bits, plen, number >> (bits - plen))
+    return None
+
+
+def parse_ports(value):
+    '''
+    Convert a port, a port range or a comma separated list of them into a
+    sorted list of non-overlapping (first, last) tuples. Return None if a
+    port is not numeric (i.e. a service name).
+    '''
+    ranges = []
+    for item in value.split(','):
+        first, sep, last = item.partition(':')
+        if not sep:
+            last = first
+        first = first or '0'
+        last = last or '65535'
+        if not (first.isdigit() and last.isdigit()):
+            return None
+        ranges.append((int(first), int(last)))
+    ranges.sort()
+    merged = [ranges[0]]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def parse_rule(line):
+    '''
+    Split an -A or -I line from an iptables-restore input into match criteria
+    and target. Criteria that are not understood are kept as opaque strings,
+    so two rules only compare equal when they are actually the same. Return
+    None for a line that can't be parsed.
+    '''
+    tokens = tokenize_rule(line)
+    if not tokens or len(tokens) < 2 or tokens[0] not in ('-A', '--append', '-I', '--insert'):
+        return None
+
+    rule = dict(
+        insert=tokens[0] in ('-I', '--insert'), chain=tokens[1], position=None,
+        proto=None, iif=None, oif=None, src=None, dst=None, sport=None, dport=None,
+        extras=[], target='', jump=None, goto=False, volatile=False)
+    i = 2
+    if rule['insert'] and i < len(tokens) and tokens[i].isdigit():
+        rule['position'] = int(tokens[i])
+        i += 1
+
+    module_name = None
+    in_target = False
+    target = []
+    negate = False
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        if token == '!':
+            negate = True
+            continue
+        args = []
+        # A comment is a single argument, whatever it starts with.
+        if token == '--comment' and i < len(tokens):
+            args.append(tokens[i])
+            i += 1
+        while i < len(tokens) and tokens[i] != '!' and not tokens[i].startswith('-'):
+            args.append(tokens[i])
+            i += 1
+        value = ' '.join(args)
+        option = BASIC_OPTIONS.get(token, token)
+
+        if option in ('jump', 'goto'):
+            rule['jump'] = value
+            rule['goto'] = option == 'goto'
+            target = ['-g' if rule['goto'] else '-j', value]
+            in_target = True
+        elif option == 'match':
+            module_name = value
+            in_target = False
+            if value in VOLATILE_MATCHES:
+                rule['volatile'] = True
+        elif in_target:
+            target.extend(['!', token] if negate else [token])
+            target.extend(args)
+        elif option == 'counters' or (module_name == 'comment' and option == '--comment'):
+            pass
+        elif negate:
+            rule['extras'].append('%s ! %s %s' % (module_name or rule['proto'], option, value))
+        elif option == 'protocol':
+            rule['proto'] = None if value in ('all', '0') else value.lower()
+        elif option in ('iif', 'oif') and value:
+            rule[option] = ('+', value[:-1]) if value.endswith('+') else ('=', value)
+        elif option in ('src', 'dst') and rule[option] is None and parse_address(value):
+            rule[option] = parse_address(value)
+        elif option in PORT_OPTIONS and rule[PORT_OPTIONS[option]] is None and parse_ports(value):
+            rule[PORT_OPTIONS[option]] = parse_ports(value)
+        else:
+            rule['extras'].append('%s %s %s' % (module_name or rule['proto'], option, value))
+        negate = False
+
+    rule['target'] = ' '.join(target)
+    rule['extras'] = frozenset(rule['extras'])
+    return rule
+
+
+def rule_signature(rule):
+    '''
+    Return the shape of the rule (which criteria it sets and how wide they
+    are) and the values of these criteria, narrowed to that shape.
+    '''
+    shape = (
+        rule['extras'],
+        rule['proto'] is not None,
+        rule['iif'] and ('=' if rule['iif'][0] == '=' else len(rule['iif'][1])),
+        rule['oif'] and ('=' if rule['oif'][0] == '=' else len(rule['oif'][1])),
+        rule['src'] and rule['src'][:2],
+        rule['dst'] and rule['dst'][:2],
+        rule['sport'] is not None)
+    return shape, project_rule(rule, shape)
+
+
+def project_interface(value, kind):
+    '''
+    Narrow an interface criterion to the given kind (exact name or prefix
+    length). Return False if it can't be done.
+    '''
+    if not kind:
+        return None
+    if value is None:
+        return False
+    if kind == '=':
+        return value[1] if value[0] == '=' else False
+    return value[1][:kind] if len(value[1]) >= kind else False
+
+
+def project_address(value, shape):
+    '''
+    Narrow an address criterion to the given (bits, prefix length). Return
+    False if it can't be done.
+    '''
+    if not shape:
+        return None
+    if value is None or value[0] != shape[0] or value[1] < shape[1]:
+        return False
+    return value[2] >> (value[1] - shape[1])
+
+
+def project_rule(rule, shape):
+    '''
+    Return the key under which a rule of the given shape would have to be
+    indexed to match at least all the packets of this rule, or None if no
+    rule of this shape can do that.
+    '''
+    extras, proto, iif, oif, src, dst, sport = shape
+    if proto and rule['proto'] is None:
+        return None
+    if sport and rule['sport'] is None:
+        return None
+    key = (
+        rule['proto'] if proto else None,
+        project_interface(rule['iif'], iif),
+        project_interface(rule['oif'], oif),
+        project_address(rule['src'], src),
+        project_address(rule['dst'], dst),
+        tuple(rule['sport']) if sport else None)
+    if any(value is False for value in key):
+        return None
+    return key
+
+
+def covering_owners(segments, ranges):
+    '''
+    Return the owners of the segments covering all the given port ranges, or
+    None if at least one port is not covered.
+    '''
+    firsts, lasts, owners = segments
+    result = []
+    for first, last in ranges:
+        i = bisect.bisect_right(firsts, first) - 1
+        port = first
+        while True:
+            if i < 0 or i >= len(firsts) or firsts[i] > port or lasts[i] < port:
+                return None
+            result.append(owners[i])
+            if lasts[i] >= last:
+                break
+            port = lasts[i] + 1
+            i += 1
+    return result
+
+
+def cover_ports(segments, ranges, owner):
+    '''
+    Add the given port ranges to segments, only where ports are not already
+    covered by a previous owner.
+    '''
+    firsts, lasts, owners = segments
+    for first, last in ranges:
+        gaps = []
+        i = bisect.bisect_right(firsts, first) - 1
+        port = first
+        if i >= 0 and lasts[i] >= port:
+            port = lasts[i] + 1
+        i += 1
+        while port <= last:
+            if i < len(firsts) and firsts[i] <= last:
+                if firsts[i] > port:
+                    gaps.append((port, firsts[i] - 1))
+                port = max(port, lasts[i] + 1)
+                i += 1
+            else:
+                gaps.append((port, last))
+                break
+        for gap_first, gap_last in gaps:
+            j = bisect.bisect_left(firsts, gap_first)
+            firsts.insert(j, gap_first)
+            lasts.insert(j, gap_last)
+            owners.insert(j, owner)
+
+
+def extras_groups(shapes, extras):
+    '''
+    Return the groups of shapes whose extra criteria are a subset of the given
+    ones. The subsets are looked up, unless there are more of them than groups
+    (that is only when a rule has a lot of extra criteria).
+    '''
+    if 2 ** len(extras) > len(shapes):
+        return [group for (key, group) in shapes.items() if key <= extras]
+    subsets = itertools.chain.from_iterable(
+        itertools.combinations(sorted(extras), n) for n in range(len(extras) + 1))
+    return [shapes[key] for key in map(frozenset, subsets) if key in shapes]
+
+
+def analyze_chain(rules):
+    '''
+    Find the rules of a chain that are never reached because earlier terminal
+    rules already match all their packets. This is a tuple space search: the
+    previous rules are indexed by shape, so each rule is checked against each
+    shape rather than against each previous rule. Return a list of (index,
+    indexes of covering rules, same target) tuples.
+    '''
+    shapes = dict()
+    dead = []
+    for idx, rule in enumerate(rules):
+        if rule is None:
+            continue
+        ranges = rule['dport'] or FULL_RANGE
+        found = None
+        for group in extras_groups(shapes, rule['extras']):
+            for shape, index in group.items():
+                key = project_rule(rule, shape)
+                if key is None or key not in index:
+                    continue
+                owners = covering_owners(index[key], ranges)
+                if owners is None:
+                    continue
+                same = all(rules[o]['target'] == rule['target'] for o in owners)
+                if found is None or same:
+                    found = (idx, sorted(set(owners)), same)
+                if same:
+                    break
+            if found and found[2]:
+                break
+        if found:
+            dead.append(found)
+            continue
+        if rule['volatile'] or not (rule['goto'] or rule['jump'] in TERMINAL_TARGETS):
+            continue
+        shape, key = rule_signature(rule)
+        index = shapes.setdefault(shape[0], dict()).setdefault(shape, dict())
+        cover_ports(index.setdefault(key, ([], [], [])), ranges, idx)
+    return dead
+
+
+def analyze_state(lines, noflush=False, only=None):
+    '''
+    Parse iptables-restore input per table and report shadowed, redundant and
+    unreachable rules, and empty user-defined chains. Also return the indexes
+    of the lines that can be removed without changing the ruleset behaviour.
+    Tables with commands other than -A and -I are not analyzed.
+    '''
+    analysis = dict()
+    obsolete = set()
+    table = None
+    for lineno, line in enumerate(lines):
+        line = COUNTERS_PREFIX_RE.sub('', line.strip())
+        if line.startswith('*'):
+            table = line[1:]
+            chains = dict()
+            policies = dict((c, ('ACCEPT', None)) for c in BUILTIN_CHAINS.get(table, []))
+            order = dict((c, ([], [])) for c in policies)
+            valid = only is None or table == only
+        elif table is None or not line or line.startswith('#'):
+            continue
+        elif line.startswith(':'):
+            name, dummy, policy = line[1:].partition(' ')
+            policies[name] = ((policy.split() or ['-'])[0], lineno)
+            order.setdefault(name, ([], []))
+        elif line == 'COMMIT':
+            if valid:
+                analysis[table] = analyze_table(chains, policies, order, noflush, obsolete)
+            table = None
+        elif valid:
+            rule = parse_rule(line)
+            if rule is None or rule['chain'] not in order:
+                module.warn("Table %s not analyzed, unsupported line: %s" % (table, line))
+                valid = False
+                continue
+            rule['lineno'] = lineno
+            rule['line'] = line
+            chains.setdefault(rule['chain'], []).append(rule)
+            head, tail = order[rule['chain']]
+            if not rule['insert']:
+                tail.append(rule)
+            elif rule['position'] is None:
+                head.append(rule)
+            else:
+                tail[:0] = head[::-1]
+                del head[:]
+                tail.insert(rule['position'] - 1, rule)
+    return analysis, obsolete
+
+
+def analyze_table(chains, policies, order, noflush, obsolete):
+    '''
+    Report the findings for one table, and add the lines to remove to the
+    obsolete set.
+    '''
+    result = dict(shadowed=[], redundant=[], unreachable=[], empty_chains=[])
+    user_chains = [c for c in policies if policies[c][0] == '-']
+
+    # Walk jumps from the built-in chains. With noflush, the current rules may
+    # also jump to any user-defined chain, so they are all kept.
+    reachable = set(c for c in policies if policies[c][0] != '-')
+    pending = list(reachable)
+    while pending:
+        for rule in chains.get(pending.pop(), []):
+            if rule['jump'] in policies and rule['jump'] not in reachable:
+                reachable.add(rule['jump'])
+                pending.append(rule['jump'])
+    if noflush:
+        reachable.update(user_chains)
+
+    for chain in sorted(policies):
+        head, tail = order[chain]
+        rules = head[::-1] + tail
+        if chain in user_chains and not rules:
+            result['empty_chains'].append(chain)
+        if chain not in reachable:
+            result['unreachable'].extend(
+                dict(chain=chain, num=n + 1, rule=r['line']) for n, r in enumerate(rules))
+            obsolete.update(r['lineno'] for r in rules)
+            obsolete.add(policies[chain][1])
+            continue
+        for idx, owners, same in analyze_chain(rules):
+            result['redundant' if same else 'shadowed'].append(dict(
+                chain=chain, num=idx + 1, rule=rules[idx]['line'], by=[o + 1 for o in owners]))
+            obsolete.add(rules[idx]['lineno'])
+    return result
+
+
+def parse_counters(string):
+    '''
+    Return the packet and byte counters of the policies and rules found in
+    iptables-save --counters output, indexed by table, chain, rule and rank
+    of the rule among identical ones.
+    '''
+    counters = dict()
+    position = dict()
+    table = None
+    for line in string.splitlines():
+        if line.startswith('*'):
+            table = line[1:].strip()
+            continue
+        policy = POLICY_COUNTERS_RE.match(line)
+        match = RULE_COUNTERS_RE.match(line)
+        if policy is not None and policy.group(2) != '-':
+            chain, target, packets, nbytes = policy.groups()
+            rule = '-P %s %s' % (chain, target)
+            num = 0
+        elif match is not None:
+            packets, nbytes, rule, chain = match.groups()
+            num = position[(table, chain)] = position.get((table, chain), 0) + 1
+        else:
+            continue
+        key = (table, chain, rule, 0)
+        while key in counters:
+            key = key[:3] + (key[3] + 1,)
+        counters[key] = (int(packets), int(nbytes), num)
+    return counters
+
+
+def sample_rates(command, samples, interval):
+    '''
+    Take snapshots of the counters and compute the packet and byte rates of
+    each rule and policy. Counters that decrease between two snapshots (i.e.
+    the rule has been replaced meanwhile) are assumed to start from zero.
+    '''
+    clock = getattr(time, 'monotonic', time.time)
+    snapshots = []
+    for n in range(samples):
+        if n:
+            time.sleep(interval)
+        before = clock()
+        (rc, out, err) = module.run_command(command, check_rc=True)
+        snapshots.append(((before + clock()) / 2, parse_counters(out)))
+
+    totals = dict()
+    for (t_prev, prev), (t_next, current) in zip(snapshots, snapshots[1:]):
+        for key, (packets, nbytes, num) in current.items():
+            if key not in prev:
+                continue
+            total = totals.setdefault(key, [0, 0, 0, num])
+            total[0] += packets - prev[key][0] if packets >= prev[key][0] else packets
+            total[1] += nbytes - prev[key][1] if nbytes >= prev[key][1] else nbytes
+            total[2] += t_next - t_prev
+            total[3] = num
+
+    rates = []
+    for (table, chain, rule, dummy), (packets, nbytes, duration, num) in totals.items():
+        rates.append(dict(
+            table=table, chain=chain, num=num, rule=rule,
+            pps=round(packets / duration, 3) if duration else 0.0,
+            bps=round(nbytes / duration, 3) if duration else 0.0,
+            packets=packets, bytes=nbytes))
+    rates.sort(key=lambda r: (r['table'], r['chain'], r['num']))
+    return rates, round(snapshots[-1][0] - snapshots[0][0], 3)
+
+
+def open_listener(proto, port, ip_version):
+    '''
+    Listen on the given port for the token the controller sends to confirm
+    the restored state. This is done once it is restored, so that no token
+    can be queued before: it has to go through the new ruleset, as a new
+    flow. Raise socket.error if the port can't be bound.
+    '''
+    family = socket.AF_INET6 if ip_version == 'ipv6' else socket.AF_INET
+    address = '::' if ip_version == 'ipv6' else '0.0.0.0'
+    kind = socket.SOCK_STREAM if proto == 'tcp' else socket.SOCK_DGRAM
+    listener = socket.socket(family, kind)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((address, port))
+        if proto == 'tcp':
+            listener.listen(5)
+    except socket.error:
+        listener.close()
+        raise
+    return listener
+
+
+def receive_token(listener, token, timeout):
+    '''
+    Wait for the token up to timeout seconds, and acknowledge it. Return True
+    if the expected token has been received.
+    '''
+    readable, dummy, dummy = select.select([listener], [], [], timeout)
+    if not readable:
+        return False
+    b_token = to_bytes(token, errors='surrogate_or_strict')
+    try:
+        if listener.type == socket.SOCK_DGRAM:
+            data, peer = listener.recvfrom(64)
+            if data.strip() != b_token:
+                return False
+            listener.sendto(b'ok\n', peer)
+            return True
+        conn, peer = listener.accept()
+        try:
+            conn.settimeout(timeout)
+            if conn.recv(64).strip() != b_token:
+                return False
+            conn.sendall(b'ok\n')
+            return True
+        finally:
+            conn.close()
+    except socket.error:
+        return False
+
+
+def remove_backup(b_back):
+    '''
+    Remove the backup file, that the controller may have removed already.
+    Return True if it was still there.
+    '''
+    try:
+        os.remove(b_back)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def split_tables(lines):
+    '''
+    Return the (table, lines) sections of an iptables state, from the table
+    declaration to its COMMIT, without the comments.
+    '''
+    sections = []
+    for line in lines:
+        if line.startswith('*'):
+            sections.append((line[1:], [line]))
+        elif sections and sections[-1][1][-1] != 'COMMIT' and not line.startswith('#'):
+            sections[-1][1].append(line)
+    return sections
+
+
+def table_blobs(lines):
+    '''
+    Return the (table, digest, data) of each table of an iptables state, data
+    being the table without the comments, as bytes, and digest its SHA-1. A
+    state without table declaration (i.e. a per table state) is returned as
+    one table with an empty name.
+    '''
+    sections = split_tables(lines)
+    if not sections:
+        sections = [('', [line for line in lines if not line.startswith('#')])]
+    blobs = []
+    for table, section in sections:
+        data = to_bytes(''.join('%s\n' % line for line in section), errors='surrogate_or_strict')
+        blobs.append((table, hashlib.sha1(data).hexdigest(), data))
+    return blobs
+
+
+def read_snapshots(b_dir):
+    '''
+    Return the list of snapshots of the store, the oldest first.
+    '''
+    b_ring = os.path.join(b_dir, b'ring.json')
+    if not os.path.exists(b_ring):
+        return []
+    try:
+        with open(b_ring, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as err:
+        module.fail_json(msg="Error reading snapshots from %s: %s" % (to_native(b_ring), to_native(err)))
+
+
+def lock_store(b_dir, exclusive=False):
+    '''
+    Open and lock the lock file of the store, so that concurrent runs of the
+    module don't lose the snapshots or remove the tables of one another. The
+    lock is released when the returned file is closed.
+    '''
+    lock = open(os.path.join(b_dir, b'lock'), 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return lock
+
+
+def write_atomically(b_path, data, compress=False):
+    '''
+    Write bytes into a temporary file of the same directory, then rename it,
+    so the store is never left with a partial file.
+    '''
+    tmpfd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(b_path))
+    with os.fdopen(tmpfd, 'wb') as f:
+        if compress:
+            with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as z:
+                z.write(data)
+        else:
+            f.write(data)
+    os.rename(tmpfile, b_path)
+
+
+def store_snapshot(b_dir, lines, keep):
+    '''
+    Add a state to the store, as compressed tables named by their digests,
+    and a snapshot referencing them. Evict the oldest snapshots beyond keep,
+    and the tables no snapshot references anymore. Return the id of the
+    snapshot, and whether the store changed.
+    '''
+    b_objects = os.path.join(b_dir, b'objects')
+    tables = []
+    blobs = dict()
+    for table, digest, data in table_blobs(lines):
+        if table:
+            blobs[digest] = data
+            tables.append([table, digest])
+    snapshot_id = hashlib.sha1(to_bytes(''.join('%s %s\n' % (t, d) for (t, d) in tables))).hexdigest()
+
+    if module.check_mode:
+        snapshots = read_snapshots(b_dir)
+        unchanged = snapshots and snapshots[-1]['id'] == snapshot_id and len(snapshots) <= keep
+        return snapshot_id, not unchanged
+
+    try:
+        if not os.path.isdir(b_objects):
+            os.makedirs(b_objects)
+        with lock_store(b_dir, exclusive=True):
+            snapshots = read_snapshots(b_dir)
+            if snapshots and snapshots[-1]['id'] == snapshot_id and len(snapshots) <= keep:
+                return snapshot_id, False
+
+            for digest, data in blobs.items():
+                b_object = os.path.join(b_objects, to_bytes('%s.gz' % digest))
+                if not os.path.exists(b_object):
+                    write_atomically(b_object, data, compress=True)
+
+            snapshots = [s for s in snapshots if s['id'] != snapshot_id]
+            snapshots.append(dict(id=snapshot_id, time=int(time.time()), tables=tables))
+            evicted = snapshots[:-keep]
+            snapshots = snapshots[-keep:]
+            write_atomically(os.path.join(b_dir, b'ring.json'), to_bytes(json.dumps(snapshots, indent=1)))
+
+            referenced = set(d for s in snapshots for (t, d) in s['tables'])
+            for digest in set(d for s in evicted for (t, d) in s['tables']) - referenced:
+                b_object = os.path.join(b_objects, to_bytes('%s.gz' % digest))
+                if os.path.exists(b_object):
+                    os.remove(b_object)
+    except (IOError, OSError) as err:
+        module.fail_json(msg="Error storing snapshot into %s: %s" % (to_native(b_dir), to_native(err)))
+
+    return snapshot_id, True
+
+
+def load_snapshot(b_dir, ref):
+    '''
+    Return the id and the lines of the snapshot matching ref, that is either
+    a (prefix of) snapshot id or a negative position from the last one.
+    '''
+    if not os.path.isdir(b_dir):
+        module.fail_json(msg="Snapshot %s not found, no store in %s" % (ref, to_native(b_dir)))
+    try:
+        lock = lock_store(b_dir)
+    except (IOError, OSError) as err:
+        module.fail_json(msg="Error locking snapshots in %s: %s" % (to_native(b_dir), to_native(err)))
+
+    with lock:
+        snapshots = read_snapshots(b_dir)
+        if ref.startswith('-') and ref[1:].isdigit() and int(ref) < 0:
+            if -int(ref) > len(snapshots):
+                module.fail_json(msg="Snapshot %s not found, only %s in store" % (ref, len(snapshots)))
+            found = [snapshots[int(ref)]]
+        elif len(ref) >= 7:
+            found = [s for s in snapshots if s['id'].startswith(ref)]
+        else:
+            found = []
+        if len(found) != 1:
+            module.fail_json(msg="Snapshot %s not found or ambiguous" % ref)
+
+        lines = []
+        for table, digest in found[0]['tables']:
+            b_object = os.path.join(b_dir, b'objects', to_bytes('%s.gz' % digest))
+            try:
+                with gzip.open(b_object, 'rb') as z:
+                    data = z.read()
+            except (IOError, OSError) as err:
+                module.fail_json(msg="Error reading table %s of snapshot %s: %s" % (table, ref, to_native(err)))
+            lines.extend(to_native(data, errors='surrogate_or_strict').splitlines())
+    return found[0]['id'], lines
+
+
+def parse_tables(lines, base=None, noflush=False, only=None):
+    '''
+    Return the chains of each table of an iptables state, as their policy and
+    the list of their rules, and the lines of the table that are neither
+    declarations nor -A, -I, -N, -P, -F, -X or -Z commands. With base (the
+    current state), tables are built the way iptables-restore does: built-in
+    chains keep their policy unless declared, and with noflush, all current
+    rules are kept, except those of the user-defined chains declared again.
+    '''
+    tables = dict()
+    chains = None
+    for line in lines:
+        line = COUNTERS_PREFIX_RE.sub('', line.strip())
+        if line.startswith('*'):
+            name = line[1:]
+            if only is not None and name != only:
+                chains = None
+                continue
+            chains = dict()
+            current = (base or dict()).get(name, (dict(), []))[0]
+            for chain, (policy, rules) in current.items():
+                if noflush:
+                    chains[chain] = [policy, list(rules)]
+                elif policy != '-':
+                    chains[chain] = [policy, []]
+            tables[name] = (chains, [])
+        elif chains is None or not line or line.startswith('#') or line == 'COMMIT':
+            continue
+        elif line.startswith(':'):
+            chain, dummy, policy = line[1:].partition(' ')
+            policy = (policy.split() or ['-'])[0]
+            if noflush and policy == '-' and chain in chains:
+                chains[chain][1] = []
+            chains.setdefault(chain, ['-', []])[0] = policy
+        else:
+            tokens = line.split()
+            if len(tokens) > 1 and tokens[0] in ('-A', '--append'):
+                chains.setdefault(tokens[1], ['-', []])[1].append(' '.join(['-A'] + tokens[1:]))
+            elif len(tokens) > 2 and tokens[0] in ('-I', '--insert'):
+                position = 0
+                if tokens[2].isdigit():
+                    position = int(tokens.pop(2)) - 1
+                chains.setdefault(tokens[1], ['-', []])[1].insert(position, ' '.join(['-A'] + tokens[1:]))
+            elif len(tokens) == 2 and tokens[0] in ('-N', '--new-chain'):
+                chains.setdefault(tokens[1], ['-', []])
+            elif len(tokens) == 3 and tokens[0] in ('-P', '--policy'):
+                chains.setdefault(tokens[1], ['-', []])[0] = tokens[2]
+            elif len(tokens) <= 2 and tokens[0] in ('-F', '--flush'):
+                for chain in tokens[1:] or list(chains):
+                    if chain in chains:
+                        chains[chain][1] = []
+            elif len(tokens) <= 2 and tokens[0] in ('-X', '--delete-chain'):
+                for chain in tokens[1:] or list(chains):
+                    if chains.get(chain, [None])[0] == '-':
+                        del chains[chain]
+            elif len(tokens) <= 2 and tokens[0] in ('-Z', '--zero'):
+                continue
+            else:
+                tables[name][1].append(line)
+    return tables
+
+
+def longest_increasing(values):
+    '''
+    Return the indexes of a longest increasing subsequence of values.
+    '''
+    tails = []
+    tails_values = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        j = bisect.bisect_left(tails_values, value)
+        if j:
+            previous[i] = tails[j - 1]
+        if j == len(tails):
+            tails.append(i)
+            tails_values.append(value)
+        else:
+            tails[j] = i
+            tails_values[j] = value
+    result = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.add(i)
+        i = previous[i]
+    return result
+
+
+def diff_chain(before, after):
+    '''
+    Compare the rules of a chain. The n-th occurrence of a rule in a list is
+    matched with the n-th one in the other list; the matched rules that are
+    out of a longest common ordered sequence are reported as moved. Return
+    None if rules are the same.
+    '''
+    if before == after:
+        return None
+
+    positions = dict()
+    occurrences = dict()
+    for i, rule in enumerate(before):
+        k = occurrences[rule] = occurrences.get(rule, -1) + 1
+        positions[(rule, k)] = i
+
+    added = []
+    sequence = []
+    occurrences = dict()
+    for n, rule in enumerate(after):
+        k = occurrences[rule] = occurrences.get(rule, -1) + 1
+        if (rule, k) in positions:
+            sequence.append((positions[(rule, k)], n))
+        else:
+            added.append(dict(num=n + 1, rule=rule))
+
+    kept = set(i for (i, n) in sequence)
+    removed = [dict(num=i + 1, rule=rule) for (i, rule) in enumerate(before) if i not in kept]
+    in_order = longest_increasing([i for (i, n) in sequence])
+    moved = [dict(num=n + 1, was=i + 1, rule=after[n])
+             for (k, (i, n)) in enumerate(sequence) if k not in in_order]
+
+    result = dict()
+    for key, value in (('added', added), ('removed', removed), ('moved', moved)):
+        if value:
+            result[key] = value
+    return result or None
+
+
+def diff_states(before, after, noflush=False, only=None):
+    '''
+    Compare two iptables states per table and per chain, and return policy
+    changes, created and deleted chains, and added, removed and moved rules.
+    Only the tables of the second state are compared, as they are the only
+    ones iptables-restore modifies.
+    '''
+    old = parse_tables(before)
+    new = parse_tables(after, old, noflush, only)
+    result = dict()
+    for table in new:
+        old_chains = old.get(table, (dict(), []))[0]
+        new_chains, unparsed = new[table]
+        policies = dict(
+            (c, [old_chains[c][0], new_chains[c][0]]) for c in new_chains
+            if c in old_chains and old_chains[c][0] != new_chains[c][0])
+        chains = dict()
+        for chain in set(old_chains) | set(new_chains):
+            changes = diff_chain(old_chains.get(chain, ['-', []])[1], new_chains.get(chain, ['-', []])[1])
+            if changes:
+                chains[chain] = changes
+        entry = dict()
+        for key, value in (
+                ('policies', policies),
+                ('created', sorted(c for c in new_chains if c not in old_chains)),
+                ('deleted', sorted(c for c in old_chains if c not in new_chains)),
+                ('chains', chains),
+                ('unparsed', unparsed)):
+            if value:
+                entry[key] = value
+        if entry:
+            result[table] = entry
+    return result
+
+
+def format_diff(result):
+    '''
+    Render the result of diff_states as text, for ansible's --diff output.
+    '''
+    lines = []
+    for table in sorted(result):
+        entry = result[table]
+        lines.append('*%s' % table)
+        lines.extend('+:%s' % c for c in entry.get('created', []))
+        lines.extend('-:%s' % c for c in entry.get('deleted', []))
+        for chain, (old, new) in sorted(entry.get('policies', dict()).items()):
+            lines.append(':%s %s -> %s' % (chain, old, new))
+        for chain, changes in sorted(entry.get('chains', dict()).items()):
+            lines.extend('-[%s] %s' % (r['num'], r['rule']) for r in changes.get('removed', []))
+            lines.extend('+[%s] %s' % (r['num'], r['rule']) for r in changes.get('added', []))
+            lines.extend('~[%s<-%s] %s' % (r['num'], r['was'], r['rule']) for r in changes.get('moved', []))
+        lines.extend('?%s' % line for line in entry.get('unparsed', []))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
 def main():
 
     global module
+    global ruleset
 
     module = AnsibleModule(
         argument_spec=dict(
-            path=dict(type='path', required=True),
-            state=dict(type='str', choices=['saved', 'restored'], required=True),
+            path=dict(type='path'),
+            state=dict(type='str', choices=['saved', 'restored', 'sampled', 'probed'], required=True),
             table=dict(type='str', choices=['filter', 'nat', 'mangle', 'raw', 'security']),
             noflush=dict(type='bool', default=False),
+            analyze=dict(type='bool', default=False),
+            prune=dict(type='bool', default=False),
             counters=dict(type='bool', default=False),
             modprobe=dict(type='path'),
+            markers=dict(type='list', elements='str', default=[]),
             ip_version=dict(type='str', choices=['ipv4', 'ipv6'], default='ipv4'),
             wait=dict(type='int'),
+            snapshot=dict(type='str'),
+            snapshot_dir=dict(type='path'),
+            snapshot_keep=dict(type='int', default=10),
+            samples=dict(type='int', default=5),
+            interval=dict(type='float', default=1),
+            confirm=dict(type='str', choices=['reconnect', 'tcp', 'udp'], default='reconnect'),
+            confirm_port=dict(type='int'),
             _timeout=dict(type='int'),
             _back=dict(type='path'),
+            _token=dict(type='str', no_log=True),
         ),
         required_together=[
             ['_timeout', '_back'],
         ],
+        mutually_exclusive=[
+            ['path', 'snapshot'],
+        ],
+        required_if=[
+            ['state', 'saved', ['path']],
+            ['state', 'sampled', ['path']],
+            ['confirm', 'tcp', ['confirm_port']],
+            ['confirm', 'udp', ['confirm_port']],
+        ],
         supports_check_mode=True,
     )
 
+    ruleset = Ruleset()
+
     # We'll parse iptables-restore stderr
     module.run_command_environ_update = dict(LANG='C', LC_MESSAGES='C')
 
@@ -384,12 +1700,23 @@ def main():
     state = module.params['state']
     table = module.params['table']
     noflush = module.params['noflush']
+    analyze = module.params['analyze']
+    prune = module.params['prune']
     counters = module.params['counters']
     modprobe = module.params['modprobe']
+    markers = module.params['markers']
     ip_version = module.params['ip_version']
     wait = module.params['wait']
+    snapshot = module.params['snapshot']
+    snapshot_dir = module.params['snapshot_dir']
+    snapshot_keep = module.params['snapshot_keep']
+    samples = module.params['samples']
+    interval = module.params['interval']
     _timeout = module.params['_timeout']
     _back = module.params['_back']
+    _token = module.params['_token']
+    confirm = module.params['confirm']
+    confirm_port = module.params['confirm_port']
 
     bin_iptables = module.get_bin_path(IPTABLES[ip_version], True)
     bin_iptables_save = module.get_bin_path(SAVE[ip_version], True)
@@ -397,6 +1724,8 @@ def main():
 
     os.umask(0o077)
     changed = False
+    listener = None
+    report = dict()
     COMMANDARGS = []
     INITCOMMAND = [bin_iptables_save]
     INITIALIZER = [bin_iptables, '-L', '-n']
@@ -429,8 +1758,52 @@ def main():
     SAVECOMMAND = list(COMMANDARGS)
     SAVECOMMAND.insert(0, bin_iptables_save)
 
+    if state == 'probed':
+        (rc, stdout, stderr) = module.run_command(SAVECOMMAND, check_rc=True)
+        probed_state = filter_and_format_state(stdout)
+        module.exit_json(
+            changed=False,
+            cmd=' '.join(SAVECOMMAND),
+            markers=dict((m, m in probed_state) for m in markers),
+            digests=dict((t, d) for (t, d) in probed_state.digests() if t))
+
+    if snapshot_dir is not None:
+        b_snapshot_dir = to_bytes(snapshot_dir, errors='surrogate_or_strict')
+        if snapshot_keep < 1:
+            module.fail_json(msg="At least 1 snapshot must be kept, got %s" % snapshot_keep)
+
+    if state == 'restored' and snapshot is not None:
+        if snapshot_dir is None:
+            module.fail_json(msg="snapshot_dir is required to restore a snapshot")
+        report['snapshot'], lines = load_snapshot(b_snapshot_dir, snapshot)
+        tmpfd, path = tempfile.mkstemp()
+        with os.fdopen(tmpfd, 'w') as f:
+            for line in lines:
+                f.write('%s\n' % line)
+        module.add_cleanup_file(path)
+    elif state == 'restored' and path is None:
+        module.fail_json(msg="path is required to restore a state, unless snapshot is set")
+
     b_path = to_bytes(path, errors='surrogate_or_strict')
 
+    if state == 'sampled':
+        if samples < 2:
+            module.fail_json(msg="At least 2 samples are needed to compute rates, got %s" % samples)
+        if interval <= 0:
+            module.fail_json(msg="Interval between samples must be positive, got %s" % interval)
+        SAMPLECOMMAND = list(SAVECOMMAND)
+        if not counters:
+            SAMPLECOMMAND.append('--counters')
+        rates, elapsed = sample_rates(SAMPLECOMMAND, samples, interval)
+        lines = ['# table chain num pps bps packets bytes rule']
+        lines.extend('%(table)s %(chain)s %(num)s %(pps)s %(bps)s %(packets)s %(bytes)s %(rule)s' % r for r in rates)
+        changed = write_state(b_path, lines, changed)
+        module.exit_json(
+            changed=changed,
+            cmd=' '.join(SAMPLECOMMAND),
+            elapsed=elapsed,
+            rates=rates)
+
     if state == 'restored':
         if not os.path.exists(b_path):
             module.fail_json(msg="Source %s not found" % path)
@@ -439,6 +1812,13 @@ def main():
         if not os.access(b_path, os.R_OK):
             module.fail_json(msg="Source %s not readable" % path)
         state_to_restore = read_state(b_path)
+        if analyze or prune:
+            report['analysis'], obsolete = analyze_state(state_to_restore, noflush, table)
+            if prune:
+                report['pruned'] = [line for (n, line) in enumerate(state_to_restore) if n in obsolete]
+            if prune and obsolete:
+                state_to_restore = ruleset.view(line for (n, line) in enumerate(state_to_restore) if n not in obsolete)
+                changed = write_state(b_path, state_to_restore, changed)
     else:
         cmd = ' '.join(SAVECOMMAND)
 
@@ -480,12 +1860,18 @@ def main():
 
     if state == 'saved':
         changed = write_state(b_path, initref_state, changed)
+        if analyze:
+            report['analysis'] = analyze_state(initref_state, only=table)[0]
+        if snapshot_dir is not None:
+            report['snapshot'], stored = store_snapshot(b_snapshot_dir, initref_state, snapshot_keep)
+            changed = changed or stored
         module.exit_json(
             changed=changed,
             cmd=cmd,
-            tables=tables_before,
-            initial_state=initial_state,
-            saved=initref_state)
+            tables=tables_lines(tables_before),
+            initial_state=initial_state.lines(),
+            saved=initref_state.lines(),
+            **report)
 
     #
     # All remaining code is for state=restored
@@ -502,6 +1888,13 @@ def main():
         dummy = write_state(b_back, initref_state, changed)
         BACKCOMMAND = list(MAINCOMMAND)
         BACKCOMMAND.append(_back)
+        # Only check the port is available: the listener is opened once the
+        # state is restored.
+        if confirm in ('tcp', 'udp') and _token is not None and not module.check_mode:
+            try:
+                open_listener(confirm, confirm_port, ip_version).close()
+            except socket.error as err:
+                module.fail_json(msg="Unable to listen on %s port %s: %s" % (confirm, confirm_port, to_native(err)))
 
     if noflush:
         MAINCOMMAND.append('--noflush')
@@ -531,21 +1924,22 @@ def main():
                 rc=rc,
                 stdout=stdout,
                 stderr=stderr,
-                tables=tables_before,
-                initial_state=initial_state,
-                restored=state_to_restore,
-                applied=False)
+                tables=tables_lines(tables_before),
+                initial_state=initial_state.lines(),
+                restored=state_to_restore.lines(),
+                applied=False,
+                **report)
 
     if module.check_mode:
-        tmpfd, tmpfile = tempfile.mkstemp()
-        with os.fdopen(tmpfd, 'w') as f:
-            for line in initial_state:
-                f.write('%s\n' % line)
-
-        if filecmp.cmp(tmpfile, b_path):
-            restored_state = initial_state
-        else:
+        # Compare rules rather than files, so comments, counters and the way
+        # the rules are written don't matter.
+        state_diff = diff_states(initial_state, state_to_restore, noflush, table)
+        # Lines that are not understood (i.e. -D or -R commands) are taken
+        # as changes.
+        if state_diff:
             restored_state = state_to_restore
+        else:
+            restored_state = initial_state
 
     else:
         # Let time enough to the plugin to retrieve async status of the module
@@ -566,13 +1960,28 @@ def main():
                 rc=rc,
                 stdout=stdout,
                 stderr=stderr,
-                tables=tables_before,
-                initial_state=initial_state,
-                restored=state_to_restore,
-                applied=False)
+                tables=tables_lines(tables_before),
+                initial_state=initial_state.lines(),
+                restored=state_to_restore.lines(),
+                applied=False,
+                **report)
+
+        # Tokens sent before this point are refused, and the controller sends
+        # them again.
+        if _back is not None and confirm in ('tcp', 'udp') and _token is not None:
+            try:
+                listener = open_listener(confirm, confirm_port, ip_version)
+            except socket.error as err:
+                module.warn("Unable to listen on %s port %s, waiting for the controller to reconnect: %s" % (
+                    confirm, confirm_port, to_native(err)))
 
         (rc, stdout, stderr) = module.run_command(SAVECOMMAND, check_rc=True)
         restored_state = filter_and_format_state(stdout)
+        if module._diff:
+            state_diff = diff_states(initial_state, restored_state, only=table)
+
+    if module._diff:
+        report['diff'] = dict(tables=state_diff, prepared=format_diff(state_diff))
 
     if restored_state not in (initref_state, initial_state):
         if module.check_mode:
@@ -586,10 +1995,11 @@ def main():
         module.exit_json(
             changed=changed,
             cmd=cmd,
-            tables=tables_before,
-            initial_state=initial_state,
-            restored=restored_state,
-            applied=True)
+            tables=tables_lines(tables_before),
+            initial_state=initial_state.lines(),
+            restored=restored_state.lines(),
+            applied=True,
+            **report)
 
     # The rollback implementation currently needs:
     # Here:
@@ -604,23 +2014,36 @@ def main():
     #   timeout
     # * task attribute 'poll' equals 0
     #
-    for dummy in range(_timeout):
+    # The backup file is removed either by the controller, or here when it
+    # sends the expected token. The loop is bound to a deadline rather than a
+    # number of iterations, so that unexpected packets received meanwhile
+    # don't shorten the delay.
+    clock = getattr(time, 'monotonic', time.time)
+    deadline = clock() + _timeout
+    confirmation = 'reconnect'
+    while clock() < deadline:
+        if listener is not None and receive_token(listener, _token, min(1, max(0, deadline - clock()))):
+            if remove_backup(b_back):
+                confirmation = 'token'
         if os.path.exists(b_back):
-            time.sleep(1)
+            if listener is None:
+                time.sleep(1)
             continue
         module.exit_json(
             changed=changed,
             cmd=cmd,
-            tables=tables_before,
-            initial_state=initial_state,
-            restored=restored_state,
-            applied=True)
+            tables=tables_lines(tables_before),
+            initial_state=initial_state.lines(),
+            restored=restored_state.lines(),
+            applied=True,
+            confirmation=confirmation,
+            **report)
 
     # Here we are: for whatever reason, but probably due to the current ruleset,
     # the action plugin (i.e. on the controller) was unable to remove the backup
     # cookie, so we restore initial state from it.
     (rc, stdout, stderr) = module.run_command(BACKCOMMAND, check_rc=True)
-    os.remove(b_back)
+    remove_backup(b_back)
 
     (rc, stdout, stderr) = module.run_command(SAVECOMMAND, check_rc=True)
     tables_rollback = per_table_state(SAVECOMMAND, stdout)
@@ -634,10 +2057,11 @@ def main():
         changed=(tables_before != tables_rollback),
         msg=msg,
         cmd=cmd,
-        tables=tables_before,
-        initial_state=initial_state,
-        restored=restored_state,
-        applied=False)
+        tables=tables_lines(tables_before),
+        initial_state=initial_state.lines(),
+        restored=restored_state.lines(),
+        applied=False,
+        **report)
 
 
 if __name__ == '__main__':